@@ -4,10 +4,12 @@ import json
 import os
 import numpy as np
 import csv
-from subprocess import check_output
-import importlib
+import sys
 import struct
+import socket
+import fcntl
 import multiprocessing as mp
+import selectors
 
 # QuadSwarm modules:
 import localize
@@ -20,6 +22,9 @@ import lib.shared_data_management
 import lib.bootloader_stm
 
 MAX_TRYS = 1
+SUPERVISOR_TIMEOUT = 1.0 #s, longest the main loop waits between state machine checks if no process reports anything
+SUPERVISOR_BACKLOG_TICK = 0.05 #s, wait between state machine checks while a pipe still has unread messages
+SIOCGIFADDR = 0x8915 #ioctl that returns an interface's IPv4 address
 
 def main(voltage_status):
     print("DEBUG: Entering main() without ATC. voltage_status =", voltage_status)
@@ -34,11 +39,8 @@ def main(voltage_status):
     ip_flag = False
     robot_id = 99
     while not ip_flag:
-        time.sleep(0.5)
         try:
-            byte_ip = check_output(['hostname', '-I'])
-            raw_ip = byte_ip.decode('utf-8')
-            ip_candidates = raw_ip.strip().split()
+            ip_candidates = get_local_ips()
             for token in ip_candidates:
                 # e.g., "10.0.0." for your local net
                 if token.startswith("10.0.0."):
@@ -47,6 +49,8 @@ def main(voltage_status):
                     break
         except:
             ip_flag = False
+        if not ip_flag:
+            time.sleep(0.5)
 
     try:
         robot_id = int(self_ip.split('.')[-1])
@@ -95,6 +99,11 @@ def main(voltage_status):
         csvfile.flush()
 
         # Main run loop – no ATC
+        # The loop sleeps on the process pipes and wakes when a process reports something (e.g. an abort),
+        # or after SUPERVISOR_TIMEOUT if nothing does.
+        selector = selectors.DefaultSelector()
+        watched_pipes = []
+        parked = set() #pipes that woke us up but haven't been read yet (see below)
         while True:
             # Let the state machine handle checks
             if stm.current_state.id in ['idle', 'running']:
@@ -108,29 +117,88 @@ def main(voltage_status):
                         pass
                     break
 
-            time.sleep(0.05)
+            # The state machine can restart processes (which makes new pipes), so keep the selector in step.
+            pipes = list(process_manager.pipes.values())
+            if pipes != watched_pipes:
+                update_watched_pipes(selector, pipes, parked)
+                watched_pipes = pipes
+
+            # A pipe that fired is unregistered until the state machine reads it, otherwise an unread message
+            # would wake us straight back up. Only those pipes are checked here.
+            for pipe in [pipe for pipe in parked if not pipe.poll()]:
+                parked.discard(pipe)
+                selector.register(pipe, selectors.EVENT_READ)
+
+            # Any pipe still parked has messages waiting (the state machine may only read one per check),
+            # so come back on the old short tick until they're read, and only wait the long timeout when idle.
+            timeout = SUPERVISOR_BACKLOG_TICK if parked else SUPERVISOR_TIMEOUT
+            for key, _ in selector.select(timeout=timeout):
+                selector.unregister(key.fileobj)
+                parked.add(key.fileobj)
 
     except KeyboardInterrupt:
         writer.writerow([now(), 'bootloader', 'KeyboardInterrupt in main'])
         csvfile.flush()
     except Exception as e:
-        writer.writerow([now(), 'bootloader', f'Error in main(): {str(e)}'])
+        rows = [[now(), 'bootloader', f'Error in main(): {str(e)}']]
         trace = traceback.extract_tb(e.__traceback__)
-        for t in trace:
-            writer.writerow([str(t)])
-        writer.writerow([str(type(e).__name__), str(e)])
+        rows.extend([str(t)] for t in trace)
+        rows.append([str(type(e).__name__), str(e)])
+        writer.writerows(rows)
         csvfile.flush()
         ret_val = 'reload'
     finally:
+        # The shutdown row goes out before kill_all(), so it's on disk even if killing the processes fails.
         writer.writerow([now(), 'bootloader', f'Final shutdown: ret_val={ret_val}'])
-        process_manager.kill_all()
-        writer.writerow([now(), 'bootloader', 'All processes killed. End main.'])
         csvfile.flush()
-        csvfile.close()
+        try:
+            process_manager.kill_all()
+            writer.writerow([now(), 'bootloader', 'All processes killed. End main.'])
+        finally:
+            csvfile.flush()
+            csvfile.close()
 
     return ret_val, voltage_status
 
 
+def update_watched_pipes(selector, pipes, parked):
+    '''
+    Makes the selector watch exactly the given pipes: ones that are gone are unregistered, new ones are registered.
+    Pipes in parked are left unregistered (the main loop registers them again once they've been read).
+    '''
+    for key in list(selector.get_map().values()):
+        if key.fileobj not in pipes:
+            selector.unregister(key.fd) #by fd, the old pipe may already be closed
+    parked.intersection_update(pipes)
+    for pipe in pipes:
+        if pipe not in parked and pipe not in selector.get_map():
+            selector.register(pipe, selectors.EVENT_READ)
+
+
+def get_local_ips():
+    '''
+    Returns the IPv4 address of each network interface (like `hostname -I`, but without forking a process).
+    Falls back to resolving the hostname if the interfaces can't be queried.
+    '''
+    ips = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            try:
+                ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+            except OSError:
+                continue #no IPv4 address on this interface (yet)
+            ip = socket.inet_ntoa(ifreq[20:24])
+            if not ip.startswith('127.'): #hostname -I leaves out loopback too
+                ips.append(ip)
+
+    if not ips:
+        try:
+            ips = [info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)]
+        except OSError:
+            pass
+    return ips
+
+
 def startup_sequence(stm, process_manager, data_manager, writer, t):
     '''
     Goes from initial state -> preflight -> idle.
@@ -265,29 +333,20 @@ class ProcessManager:
 
 
 if __name__ == "__main__":
-    voltage_status = 'normal'
-    tries = 0
-    while tries < MAX_TRYS:
-        ret_val, voltage_status = main(voltage_status)
-        print(f"DEBUG: main() returned {ret_val}, {voltage_status}")
-        if ret_val == 'normal':
-            break
-        else:
-            tries += 1
+    # A retry re-executes the interpreter (fresh modules, fresh mp state) instead of reloading modules,
+    # so the try count and voltage status are carried across in the environment.
+    voltage_status = os.environ.get('BOOTLOADER_VOLTAGE_STATUS', 'normal')
+    tries = int(os.environ.get('BOOTLOADER_TRIES', '0'))
+    ret_val, voltage_status = main(voltage_status)
+    print(f"DEBUG: main() returned {ret_val}, {voltage_status}")
+    if ret_val != 'normal':
+        tries += 1
+        if tries < MAX_TRYS:
             print("DEBUG: Retrying main() in 2s")
             time.sleep(2)
-            # Optionally reload modules
-            try:
-                importlib.reload(localize)
-                importlib.reload(fc_handler)
-                importlib.reload(control_manager)
-                importlib.reload(user_code_handler)
-                importlib.reload(logbook)
-                importlib.reload(comms)
-                importlib.reload(lib.shared_data_management)
-                importlib.reload(lib.bootloader_stm)
-            except Exception as e:
-                print(f"DEBUG: Error reloading modules: {e}")
-                break
+            os.environ['BOOTLOADER_TRIES'] = str(tries)
+            os.environ['BOOTLOADER_VOLTAGE_STATUS'] = voltage_status
+            sys.stdout.flush() #execv doesn't flush python's buffers
+            os.execv(sys.executable, [sys.executable] + sys.argv)
 
     print("DEBUG: Exiting bootloader after tries=", tries)
@@ -1,37 +1,41 @@
 #!/usr/bin/env python3
+import os
 import socket
 import time
 import struct
 
+# Set FAKE_TRACKING_DEBUG=1 to print every packet sent.
+DEBUG = os.environ.get('FAKE_TRACKING_DEBUG', '0') == '1'
+
 def main():
     # Create a UDP socket and enable broadcasting
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    addr = ('<broadcast>', 54321)
 
     sequence_number = 0
 
-    while True:
-        # Use a constant float value 0.0 so its binary representation is all zeros.
-        constant_time = 0.0
-
-        # Build a 14-byte preamble:
-        #   5s   => 5-byte string: b'opti1'
-        #   f    => 4-byte float: constant_time (0.0 → b'\x00\x00\x00\x00')
-        #   H    => 2-byte unsigned short: sequence number
-        preamble = struct.pack('5sfH', b'opti1', constant_time, sequence_number)
+    # The packet is built once; only the sequence number changes between sends.
+    # 14-byte preamble (native alignment, same as the listener/localize unpack):
+    #   5s   => 5-byte string: b'opti1'  (+3 pad bytes)
+    #   f    => 4-byte float: constant_time 0.0, so its binary representation is all zeros
+    #   H    => 2-byte unsigned short: sequence number
+    # The listener/localize code expects 29 bytes per "body."
+    # We'll send 29 dummy bytes, which bytearray already zero-fills.
+    preamble_size = struct.calcsize('5sfH')
+    sequence_offset = struct.calcsize('5sf')
+    packet = bytearray(preamble_size + 29)
+    struct.pack_into('5sfH', packet, 0, b'opti1', 0.0, sequence_number)
 
-        # The listener/localize code expects 29 bytes per “body.”
-        # We'll send 29 dummy bytes.
-        body = b'\x00' * 29
-
-        # Combine preamble and body into one packet
-        packet = preamble + body
+    while True:
+        struct.pack_into('H', packet, sequence_offset, sequence_number)
 
         # Print debug info
-        print(f"[DEBUG] Sending packet: opti1, constant_time=0.0, seq={sequence_number}, size={len(packet)} bytes")
+        if DEBUG:
+            print(f"[DEBUG] Sending packet: opti1, constant_time=0.0, seq={sequence_number}, size={len(packet)} bytes")
 
         # Broadcast the packet to port 54321 on your local subnet
-        sock.sendto(packet, ('<broadcast>', 54321))
+        sock.sendto(packet, addr)
 
         # Increment the sequence number (wrap at 65535)
         sequence_number = (sequence_number + 1) % 65536
@@ -14,12 +14,55 @@ from lib.shared_data_management import SharedDataManager
 
 #import native libraries
 import time
+import struct
 import numpy as np
 from itertools import cycle
 import traceback
 
 
-np.seterr(all='raise')
+#positions of each channel in the CMDS array (see CMDS_ORDER)
+ROLL, PITCH, THROTTLE, YAW, AUX1, AUX2 = range(6)
+
+# It's necessary to send some messages or the RX failsafe will be activated
+# and it will not be possible to arm.
+# The MSP codes never change, so they are looked up once here instead of every time we connect.
+KEEPALIVE_CODES = tuple(MSPy.MSPCodes[msg] for msg in [
+                        'MSP_API_VERSION', 'MSP_FC_VARIANT', 'MSP_FC_VERSION', 'MSP_BUILD_INFO',
+                        'MSP_BOARD_INFO', 'MSP_UID', 'MSP_ACC_TRIM', 'MSP_NAME', 'MSP_STATUS', 'MSP_STATUS_EX',
+                        'MSP_BATTERY_CONFIG', 'MSP_BATTERY_STATE', 'MSP_BOXNAMES'])
+INAV_KEEPALIVE_CODES = tuple(MSPy.MSPCodes[msg] for msg in ['MSPV2_INAV_ANALOG', 'MSP_VOLTAGE_METER_CONFIG'])
+MSP_ANALOG = MSPy.MSPCodes['MSP_ANALOG']
+MSP_SET_RAW_RC = MSPy.MSPCodes['MSP_SET_RAW_RC']
+
+#MSP v1 RC frame: '$M<', payload size, code, 6 little-endian uint16 channels, xor checksum
+RC_FRAME = struct.Struct('<3sBB6HB')
+
+
+def pack_rc_frame(frame, rc):
+    '''
+    Writes the MSP_SET_RAW_RC frame for the 6 RC channels (in CMDS_ORDER) into frame, a bytearray of RC_FRAME.size bytes.
+    These are the same bytes board.send_RAW_RC writes, without yamspy converting every channel into a list of bytes first.
+    The frame is filled in place so the same buffer can be reused every tick.
+    '''
+    RC_FRAME.pack_into(frame, 0, b'$M<', 12, MSP_SET_RAW_RC, *rc, 0)
+
+    #the checksum is the xor of the size, code, and payload bytes
+    checksum = 0
+    for i in range(3, RC_FRAME.size - 1):
+        checksum ^= frame[i]
+    frame[-1] = checksum
+
+
+def command_as_float(value):
+    '''
+    Reads one command value as a float. Anything that can't be read as a number comes back as nan,
+    so _fc_protector can default just that channel instead of all of them.
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError): #OverflowError for ints too big for a float
+        return float('nan')
+
 
 class FlightControllerInterface():
     '''
@@ -38,14 +81,15 @@ class FlightControllerInterface():
         self.bootloader_pipe_connection = conn
 
         #set up variables for communicating with the board.
-        self.CMDS = {
-                'roll':     1500,
-                'pitch':    1500,
-                'throttle': 900,
-                'yaw':      1500,
-                'aux1':     1000, #1800 is arm
-                'aux2':     1500
-                }
+        #the channels are stored in CMDS_ORDER order so the array can go straight to the board.
+        self.CMDS = np.array([
+                1500,   #roll
+                1500,   #pitch
+                900,    #throttle
+                1500,   #yaw
+                1000,   #aux1 (1800 is arm)
+                1500    #aux2
+                ], dtype=np.int16)
         
         #aux 1 modes:
         # 1000 == DISARM
@@ -58,15 +102,17 @@ class FlightControllerInterface():
 
         # This order is the important bit: it will depend on how your flight controller is configured.
         # Below it is considering the flight controller is set to use AETR.
-        # The names here don't really matter, they just need to match what is used for the CMDS dictionary.
+        # The names here don't really matter, they just document the index constants used for the CMDS array.
         # In the documentation, iNAV uses CH5, CH6, etc while Betaflight goes AUX1, AUX2...
         self.CMDS_ORDER = ['roll', 'pitch', 'throttle', 'yaw', 'aux1', 'aux2']
-        self.slow_msgs = cycle(['MSP_ANALOG']) #cycle(['MSP_ANALOG', 'MSP_STATUS_EX', 'MSP_MOTOR', 'MSP_RC'])
+        self.rc_frame = bytearray(RC_FRAME.size) #reused for every RC frame sent to the board (see pack_rc_frame)
+        self.slow_msgs = cycle([MSP_ANALOG]) #cycle([MSP_ANALOG, MSPy.MSPCodes['MSP_STATUS_EX'], MSPy.MSPCodes['MSP_MOTOR'], MSPy.MSPCodes['MSP_RC']])
         self.SERIAL_PORT = "/dev/serial0"
         self.ARMED = False
         self.CMDS_FREQ = 0.0
         self.SLOW_MSGS_LOOP_TIME = 1/5 # these messages take a lot of time slowing down the loop...
-        self.last_slow_msg_time = time.time()
+        self.SLOW_MSGS_LOOP_NS = int(self.SLOW_MSGS_LOOP_TIME * 1_000_000_000) #integer ns so the loop can compare against time.monotonic_ns()
+        self.last_slow_msg_ns = time.monotonic_ns()
         
         #Battery management
         self.voltage = -1.0 #initialize to -1 so we know the voltage has been read (it'll read a positive value)
@@ -78,7 +124,8 @@ class FlightControllerInterface():
         #This is the threshold under which a low voltage immediate controlled landing is initiated.
         self.low_voltage_threshold = 6.4 #Volts
         self.low_voltage_threshold_timer = 3 #s (if the battery voltage is below the threshold for this many seconds, we will trigger an auto-land)
-        self.last_time_above_threshold = time.time()
+        self.low_voltage_threshold_timer_ns = self.low_voltage_threshold_timer * 1_000_000_000
+        self.last_ns_above_threshold = time.monotonic_ns()
 
         #controller limits
         self.max_diff = 50
@@ -95,7 +142,11 @@ class FlightControllerInterface():
 
         data_manager = SharedDataManager(shared_data)
 
-        self.bootloader_pipe_connection.send('fc handler trying to connect')
+        #bound once so the control loop doesn't look these up every pass
+        send_to_bootloader = self.bootloader_pipe_connection.send
+        low_voltage_threshold = self.low_voltage_threshold
+
+        send_to_bootloader('fc handler trying to connect')
 
         try:
             with MSPy(device=self.SERIAL_PORT, loglevel='WARNING', baudrate=115200) as board:
@@ -107,19 +158,14 @@ class FlightControllerInterface():
                 #Flag that we have connected with the board, so the watch dog dimer doesn't go off.
                 data_manager.set_board_connected(1)
 
-                # It's necessary to send some messages or the RX failsafe will be activated
-                # and it will not be possible to arm.
-                #here we build that initial command list
-                command_list = ['MSP_API_VERSION', 'MSP_FC_VARIANT', 'MSP_FC_VERSION', 'MSP_BUILD_INFO', 
-                                'MSP_BOARD_INFO', 'MSP_UID', 'MSP_ACC_TRIM', 'MSP_NAME', 'MSP_STATUS', 'MSP_STATUS_EX',
-                                'MSP_BATTERY_CONFIG', 'MSP_BATTERY_STATE', 'MSP_BOXNAMES']
+                #here we pick that initial command list (see KEEPALIVE_CODES)
+                command_list = KEEPALIVE_CODES
                 if board.INAV:
-                    command_list.append('MSPV2_INAV_ANALOG')
-                    command_list.append('MSP_VOLTAGE_METER_CONFIG')
+                    command_list = command_list + INAV_KEEPALIVE_CODES
 
                 #send initial commands to prevent the RX failsafe from activating
-                for msg in command_list: 
-                    if board.send_RAW_msg(MSPy.MSPCodes[msg], data=[]):
+                for code in command_list:
+                    if board.send_RAW_msg(code, data=[]):
                         dataHandler = board.receive_msg()
                         board.process_recv_data(dataHandler)
                 
@@ -141,7 +187,7 @@ class FlightControllerInterface():
                     #process them (i.e., we won't write them into the CMDS array)
                     commands, success = data_manager.get_commands(clear_fresh_flag=True, blocking=False)
                     if success:
-                        #process them into the dictionary values
+                        #process them into the CMDS array
                         #also checks to make sure they are safe for the flight controller
                         self._process_cmds(commands)
 
@@ -151,60 +197,68 @@ class FlightControllerInterface():
                     safety = data_manager.get_safety()
                     if safety == 1 or safety == 2:
                         board.reboot()
-                        self.bootloader_pipe_connection.send('The flight controller has responded to an emergency stop code %d. The board has been reset.' % safety)
+                        send_to_bootloader('The flight controller has responded to an emergency stop code %d. The board has been reset.' % safety)
                         time.sleep(0.5) #this gives the board a moment to reset and the logger a moment to log.
                         data_manager.set_safety(0) #the safety is non-zero, so we have to make it zero in order to set it to 5.
                         data_manager.set_safety(5) #We do this, so we won't be able to start a new user code until the FC has connected again.
                         return
                     
-                    # self.CMDS['aux1'] = 1800
-                    # self.CMDS['throttle'] = 900
-                    # self.CMDS['roll'] = 1500
-                    # self.CMDS['pitch'] = 1500
-                    # self.CMDS['yaw'] = 1500
-                    # self.CMDS['aux2'] = 1500
+                    # self.CMDS[AUX1] = 1800
+                    # self.CMDS[THROTTLE] = 900
+                    # self.CMDS[ROLL] = 1500
+                    # self.CMDS[PITCH] = 1500
+                    # self.CMDS[YAW] = 1500
+                    # self.CMDS[AUX2] = 1500
 
                     #Push controls to FC
-                    # Send the RC channel values to the FC
-                    if board.send_RAW_RC([self.CMDS[ki] for ki in self.CMDS_ORDER]):
-                        dataHandler = board.receive_msg()
-                        board.process_recv_data(dataHandler)
+                    # Send the RC channel values to the FC (written straight to the serial port, see pack_rc_frame)
+                    pack_rc_frame(self.rc_frame, self.CMDS)
+                    if board.conn.write(self.rc_frame):
+                        #the FC acks MSP_SET_RAW_RC with an empty reply, so it only has to be read off the port.
+                        #(process_recv_data would look up yamspy's handler for it by name, and that handler does nothing)
+                        board.receive_msg()
 
                     #
                     # Communicate slow messages with the FC 
                     # SLOW MSG processing (user GUI)
                     #
-                    if (time.time()-self.last_slow_msg_time) >= self.SLOW_MSGS_LOOP_TIME:
-                        self.last_slow_msg_time = time.time()
+                    #monotonic so a wall clock jump (NTP, etc.) can't fire the slow messages or the low voltage timer early
+                    now_ns = time.monotonic_ns()
+                    if now_ns - self.last_slow_msg_ns >= self.SLOW_MSGS_LOOP_NS:
+                        self.last_slow_msg_ns = now_ns
 
-                        next_msg = next(self.slow_msgs) # circular list
+                        next_code = next(self.slow_msgs) # circular list
 
                         # Read info from the FC
-                        if board.send_RAW_msg(MSPy.MSPCodes[next_msg], data=[]):
+                        if board.send_RAW_msg(next_code, data=[]):
                             dataHandler = board.receive_msg()
                             board.process_recv_data(dataHandler)
                             
                         #get the battery info if that's the message we inquired about
-                        if next_msg == 'MSP_ANALOG':
-                            self.voltage = board.ANALOG['voltage']
-                            self.amperage = board.ANALOG['amperage']
-                            self.mAhdrawn = board.ANALOG['mAhdrawn']
-                            self.power = self.amperage * self.voltage 
-
-                            data_manager.set_battery_voltage(self.voltage)
-                            data_manager.set_battery_power(self.power)
+                        if next_code == MSP_ANALOG:
+                            analog = board.ANALOG
+                            voltage = analog['voltage']
+                            amperage = analog['amperage']
+                            power = amperage * voltage
+                            self.voltage = voltage
+                            self.amperage = amperage
+                            self.mAhdrawn = analog['mAhdrawn']
+                            self.power = power
+
+                            data_manager.set_battery_voltage(voltage)
+                            data_manager.set_battery_power(power)
 
                             #check the battery voltage
-                            if self.voltage < self.low_voltage_threshold:
+                            if voltage < low_voltage_threshold:
                                 #If more than the low_voltage_threshold_timer time as passed since we were last above the threshold,
                                 #then we will initialize a safety code 30
-                                if self.last_slow_msg_time - self.last_time_above_threshold >= self.low_voltage_threshold_timer:
+                                if self.last_slow_msg_ns - self.last_ns_above_threshold >= self.low_voltage_threshold_timer_ns:
                                     data_manager.set_safety(4)
-                                    self.bootloader_pipe_connection.send('LOW VOLTAGE WARNING!! ' + str(self.voltage))
+                                    send_to_bootloader('LOW VOLTAGE WARNING!! ' + str(voltage))
                                     data_manager.set_low_voltage_warning()
                             else:
                                 #if not below threshold, reset the last time we saw a voltage above the threshold
-                                self.last_time_above_threshold = self.last_slow_msg_time
+                                self.last_ns_above_threshold = self.last_slow_msg_ns
         except Exception as error:
 
             #log the error and continue
@@ -214,7 +268,7 @@ class FlightControllerInterface():
                 logMessage.append(str(t))
             logMessage.append([str(type(error).__name__)])
             logMessage.append([str(error)])
-            self.bootloader_pipe_connection.send(logMessage) #send the error to the bootloader to be logged
+            send_to_bootloader(logMessage) #send the error to the bootloader to be logged
             return
 
 
@@ -223,112 +277,87 @@ class FlightControllerInterface():
 
     def _process_cmds(self, commands):
         '''
-        Accepts an array of commands and stores them in the CMDS dictionary.
+        Accepts an array of commands and stores them in the CMDS array.
         Input array: AETR (roll, pitch, throttle, yaw), ARM, and MODE
         '''
 
-        #First, make sure each AETR command is safe
-        for i,c in enumerate(commands[0:4]):
-            if i == 0:
-                key = 'roll'
-            elif i == 1:
-                key = 'pitch'
-            elif i == 2:
-                key = 'throttle'
-            elif i == 3:
-                key = 'yaw'
-            new_c = self._fc_protector(c, self.CMDS[key])
-            commands[i] = new_c
-
-        #Then write the commands into the CMDS dictionary so it can go to the fc board.
-        self.CMDS['roll'] = commands[0]
-        self.CMDS['pitch'] = commands[1]
-        self.CMDS['throttle'] = commands[2]
-        self.CMDS['yaw'] = commands[3]
-        self.CMDS['aux1'] = commands[4]
-        self.CMDS['aux2'] = commands[5]
-
-    def _fc_protector(self, control_value, old_value):
+        #First, make sure each AETR command is safe (all four channels at once)
+        new_values = self._fc_protector(commands[0:4], self.CMDS[ROLL:AUX1])
+
+        #Then write the commands into the CMDS array so it can go to the fc board.
+        self.CMDS[ROLL:AUX1] = new_values
+        self.CMDS[AUX1] = commands[4]
+        self.CMDS[AUX2] = commands[5]
+
+    def _fc_protector(self, control_values, old_values):
         '''
-        Compares a new control value w. the old value. Makes sure it's within max diff and within max/min absolutes.
-        Returns the updated (bounded) value if necessary
+        Compares the new AETR control values w. the old values. Makes sure each is within max diff and within max/min absolutes.
+        Returns the updated (bounded) values as an int32 array
         '''
-        try:
-            #First, make sure the jump isn't too big.
-            control_value = int(control_value)
-            old_value = int(old_value)
-            if abs(control_value - old_value) > self.max_diff:
-                if control_value < old_value:
-                    control_value = old_value - (self.max_diff)
-                elif control_value > old_value:
-                    control_value = old_value + (self.max_diff)
-
-            #then make sure its within the max-min command range.
-            if control_value > self.max_command:
-                return self.max_command
-            elif control_value < self.min_command:
-                return self.min_command
-            else:
-                return control_value
-            
-        except:
-            #'there was a run time warning'
-            #happens if calculation fails (some overflow or something due to large numbers that shouldn't be (or dvide by zero or something))
-            #default to a 1500 return value as a safety.
-            return 1500
+        control_values = np.array([command_as_float(c) for c in control_values], dtype=np.float64)
+
+        #nan/inf happens if the calculation upstream failed (some overflow or divide by zero or something),
+        #or if the command wasn't a number at all. Those channels default to a 1500 return value as a safety.
+        invalid = ~np.isfinite(control_values)
+        control_values = np.trunc(np.where(invalid, old_values, control_values))
 
+        #First, make sure the jump isn't too big, then make sure its within the max-min command range.
+        delta = np.clip(control_values - old_values, -self.max_diff, self.max_diff)
+        bounded = np.clip(old_values + delta, self.min_command, self.max_command).astype(np.int32)
+        bounded[invalid] = 1500
+        return bounded
 
     def initial_cmds(self, X, board):
         '''
         The initial disarm commands while the drone boots up.
         '''
-        start_time = time.time()
-        start_up_time = X #s
-        while time.time() < start_time + start_up_time:
-            self.CMDS['aux1'] = 1000 #Send disarm command.
-
-            self.CMDS['aux2'] = 1500
-            #aux 2 modes:
-            # 1500 == horizon
-            # 1000 == angle
-            # 2000 = Flip
-
-            #AETR are default/min
-            self.CMDS['throttle'] = 900
-            self.CMDS['roll'] = 1500
-            self.CMDS['pitch'] = 1500
-            self.CMDS['yaw'] = 1500
+        self.CMDS[AUX1] = 1000 #Send disarm command.
 
-            #Push controls to FC
-            # Send the RC channel values to the FC
-            if board.send_RAW_RC([self.CMDS[ki] for ki in self.CMDS_ORDER]):
-                dataHandler = board.receive_msg()
-                board.process_recv_data(dataHandler)
+        self.CMDS[AUX2] = 1500
+        #aux 2 modes:
+        # 1500 == horizon
+        # 1000 == angle
+        # 2000 = Flip
+
+        #AETR are default/min
+        self.CMDS[THROTTLE] = 900
+        self.CMDS[ROLL] = 1500
+        self.CMDS[PITCH] = 1500
+        self.CMDS[YAW] = 1500
+
+        self._repeat_cmds(X, board)
 
     def foobar(self, X, board):
         '''
         The initial disarm commands while the drone boots up.
         '''
-        start_time = time.time()
-        start_up_time = X #s
-        while time.time() < start_time + start_up_time:
-            self.CMDS['aux1'] = 1800 #Send ARM command.
-
-            self.CMDS['aux2'] = 1500
-            #aux 2 modes:
-            # 1500 == horizon
-            # 1000 == angle
-            # 2000 = Flip
-
-            #AETR are default/min
-            self.CMDS['throttle'] = 900
-            self.CMDS['roll'] = 1500
-            self.CMDS['pitch'] = 1500
-            self.CMDS['yaw'] = 1500
+        self.CMDS[AUX1] = 1800 #Send ARM command.
 
+        self.CMDS[AUX2] = 1500
+        #aux 2 modes:
+        # 1500 == horizon
+        # 1000 == angle
+        # 2000 = Flip
+
+        #AETR are default/min
+        self.CMDS[THROTTLE] = 900
+        self.CMDS[ROLL] = 1500
+        self.CMDS[PITCH] = 1500
+        self.CMDS[YAW] = 1500
+
+        self._repeat_cmds(X, board)
+
+    def _repeat_cmds(self, X, board):
+        '''
+        Keeps sending the current CMDS to the FC for X seconds.
+        The commands don't change in that time, so the frame is only packed once.
+        '''
+        frame = self.rc_frame
+        pack_rc_frame(frame, self.CMDS)
+        write = board.conn.write
+        end_time = time.time() + X #s
+        while time.time() < end_time:
             #Push controls to FC
             # Send the RC channel values to the FC
-            if board.send_RAW_RC([self.CMDS[ki] for ki in self.CMDS_ORDER]):
-                dataHandler = board.receive_msg()
-                board.process_recv_data(dataHandler)
-        
\ No newline at end of file
+            if write(frame):
+                board.receive_msg() #empty ack, nothing to process (see run)
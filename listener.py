@@ -1,12 +1,17 @@
 import socket
 import os
+import sys
 import time
-import numpy as np
 import struct
+import ctypes
+import errno
+import asyncio
+import heapq
 
 class Bot():
     def __init__(self, id) -> None:
         self.id = id
+        self.id_str = format(id, '02d') #ids don't change, so the padded version for printing is made once
         self.state = 'off'
         self.voltage = 0
         self.last_command = 'none'
@@ -17,209 +22,264 @@ class Bot():
 NUM_BOTS = 50
 BOT_START_NUM = 5
 TIMEOUT = 10 #s
-
-def main():
-
-    try: 
-        port = 60402
-        #This creates a UDP socket 
-        recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        #This allows the socket address to be reused (which I think helps with the sender socket above)
-        recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        #We're going to listen to anything coming over the port on the localhost network
-        recv_socket.bind(('localhost', port))
-        recv_socket.setblocking(1) #0.5 second timeout
-        recv_socket.settimeout(0.5)
-
-        #create all of the robots that we will be tracking
-        bots = []
-        for i in range(BOT_START_NUM, BOT_START_NUM+NUM_BOTS):
-            bot = Bot(i)
-            bots.append(bot)
-
-        #lists to help us keep track of data that needs updating, etc.
-        data_to_update = {}
-        bots_to_update = []
-        has_been_on = []
-
-        #optitrack data
-        num_bots = 0
-        opti_loss = 0
-        optitime = 0
-        heartbeat = 0
-        count_diff = 0
-        avg_time_between = 0.0
-
-        reprint = True #used so we only print when we get new robot data (otherwise print too fast b/c of optitrack data)
-        time_of_last_print = 0
-        time_between_prints = 0.5
-        reprint_debounce_time = 0.3
-
-        opti_udp = OptitrackInterfaceUDP()
-
+CLEAR = '\x1b[H\x1b[2J' #ANSI: cursor home + clear screen (same as the `clear` command, without starting a process)
+VALID_TAGS = frozenset({b'opti1', b'opti2'}) #tags at the start of an optitrack packet ('opti1' for IDs 5-29 and 'opti2' for IDs 30-54)
+
+#Optitrack packets are pulled off the socket in batches with recvmmsg (linux) instead of one recvfrom per packet.
+RECV_BATCH = 32 #packets per call
+RECV_SIZE = 1024 #bytes per packet
+RCVBUF_SIZE = 8*1024*1024 #bytes, optitrack socket receive buffer (several seconds of packets)
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33) #linux only, not always exposed by the socket module
+SO_INCOMING_CPU = getattr(socket, 'SO_INCOMING_CPU', 49) #linux only, same as above
+
+class IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+try:
+    recvmmsg = ctypes.CDLL(None, use_errno=True).recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    recvmmsg = None #not linux, use recvfrom instead
+
+async def main():
+
+    loop = asyncio.get_running_loop()
+
+    port = 60402
+    #This creates a UDP socket
+    recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    #This allows the socket address to be reused (which I think helps with the sender socket above)
+    recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    #We're going to listen to anything coming over the port on the localhost network
+    recv_socket.bind(('localhost', port))
+    #non-blocking: the event loop does the waiting for both this socket and the optitrack socket
+    recv_socket.setblocking(False)
+
+    #create all of the robots that we will be tracking
+    bots = []
+    for i in range(BOT_START_NUM, BOT_START_NUM+NUM_BOTS):
+        bot = Bot(i)
+        bots.append(bot)
+    bots_by_id = {bot.id: bot for bot in bots}
+
+    #set to help us keep track of which bots have been on
+    has_been_on = set()
+
+    #timeouts: every update pushes (time it runs out, id, update number) onto a heap, so the reprint only looks at
+    #the bots whose time is up instead of checking all of them. The update number marks older entries for the same bot as stale.
+    expiry_heap = []
+    update_seq = {bot.id: 0 for bot in bots}
+    timed_out = set()
+
+    #optitrack data
+    opti_info = {'num_bots': 0, 'opti_loss': 0, 'count_diff': 0, 'avg_time_between': 0.0}
+    heartbeat = 0
+
+    time_between_prints = 0.5
+
+    #on a machine with more than one network card, set OPTITRACK_IFACE_IP to this machine's address on the optitrack network
+    opti_udp = OptitrackInterfaceUDP(iface_ip=os.environ.get('OPTITRACK_IFACE_IP', '0.0.0.0'))
+    set_realtime(opti_udp.client_socket)
+
+    def receive_bots():
+        '''
+        Called by the event loop whenever the robot socket has data.
+        Pulls every message off the socket and puts the new data straight onto the bots.
+        '''
+        now = time.time()
+        #get a list of messages (unpack the raw data), until there are none left on the socket
         while True:
-
-            timeout_bots = []
-
-            if reprint and time.time() - time_of_last_print <= reprint_debounce_time:
-                reprint = False
-
-            if reprint:
-                heartbeat += 1
-                if heartbeat > 100:
-                    heartbeat = 0
-                time_of_last_print = time.time()
-
-                os.system('clear')
-                print('ID    Safety\tState\t\tLast CMD\tVoltage\t\tUsrCode')
-                now = time.time()
-                for i,bot in enumerate(bots):
-                    if bot.id in bots_to_update:
-                        bot.voltage = data_to_update[bot.id][0]
-                        bot.state = data_to_update[bot.id][1]
-                        bot.last_command = data_to_update[bot.id][2]
-                        bot.safety = data_to_update[bot.id][3]
-                        bot.user_code = data_to_update[bot.id][4]
-                        bot.last_update_time = now
-
-                    #keep track of any bots that may have timed out (we haven't heard from in forever.)
-                    if bot.id in has_been_on:
-                        if now >= bot.last_update_time + TIMEOUT:
-                            bot.voltage = 0
-                            bot.state = 'off'
-                            bot.last_command = 'none'
-                            bot.safety = 0
-                            bot.user_code = 'none'
-                            timeout_bots.append(bot.id)
-
-
-                    
-
-                    id = str(bot.id).zfill(2)
-                    print("%s\t%d\t%s\t\t%s\t\t%0.2f\t\t%s" % (id, bot.safety, bot.state, bot.last_command, bot.voltage, bot.user_code))
-
-                print('\n')
-                print('Optitrack Info:')
-                print('Bodies: %d\tLR: %0.2f\t Missed Counts: %d\tHB: %d' %(num_bots, opti_loss, count_diff, heartbeat))
-                print('Time btwn: %0.3f' %(avg_time_between), '\tTimeout bots: ' + str(timeout_bots))
-
-
-                reprint = False
-            else:
-                if time.time() - time_of_last_print > time_between_prints:
-                    reprint = True
-
-
-            #get a list of messages (unpack the raw data)
             try:
-                data_to_update = {}
-                bots_to_update = []
-
                 raw_recv_data = recv_socket.recv(1024)
-                recv_data = raw_recv_data.decode('utf-8')
-                data = process_inbound(recv_data)
-
-                if data == False:
-                    pass
-                else:
-                    #parse the messages and record what needs to be updated
-                    #message in the order: id, volts, safety code, state, last command, user code file
-                    for msg in data:
-                        
-                        sender = int(msg[0])
-                        volts = float(msg[1])
-                        safety = int(msg[2])
-                        state = msg[3]
-                        last_command = msg[4]
-                        user_code = msg[5]
-                        data_to_update[sender] = [volts, state, last_command, safety, user_code]
-                        bots_to_update.append(sender)
-                        if sender not in has_been_on:
-                            has_been_on.append(sender)
-                        if state == 'off' and sender in has_been_on:
-                            has_been_on.pop(has_been_on.index(sender))
-
-                        reprint = True
-    
             except BlockingIOError:
-                # print('timeout')
-                pass
-            except TimeoutError:
-                pass
+                break
+            data = process_inbound(raw_recv_data)
+
+            #parse the messages and update the bots
+            #message in the order: id, volts, safety code, state, last command, user code file
+            for msg in data:
+
+                sender = int(msg[0])
+                bot = bots_by_id.get(sender)
+                if bot is None: #not one of the bots we are tracking, don't bother parsing the rest
+                    continue
+                bot.voltage = float(msg[1])
+                bot.safety = int(msg[2])
+                bot.state = msg[3].decode('utf-8')
+                bot.last_command = msg[4].decode('utf-8')
+                bot.user_code = msg[5].decode('utf-8')
+                bot.last_update_time = now
+                update_seq[sender] += 1
+                heapq.heappush(expiry_heap, (now + TIMEOUT, sender, update_seq[sender]))
+                timed_out.discard(sender)
+                has_been_on.add(sender)
+                if bot.state == 'off':
+                    has_been_on.discard(sender)
+
+    def receive_optitrack():
+        '''
+        Called by the event loop whenever the optitrack socket has data.
+        '''
+        #NOW GET DATA FROM OPTITRACK!!!
+        opti_data = opti_udp.run()
+        # print(opti_data)
+        if opti_data == False:
+            pass
+        else:
+            # print(opti_data)
+            opti_info['num_bots'] = opti_data[0]
+            opti_info['opti_loss'] = opti_data[1]
+            opti_info['count_diff'] = opti_data[2]
+            opti_info['avg_time_between'] = opti_data[3]
 
-            # print('checking optitrack')
+    def reprint():
+        '''
+        Redraws the screen, then schedules itself to run again in time_between_prints.
+        This runs off a timer instead of inside the receive loop, so packets are never left waiting on a redraw.
+        '''
+        nonlocal heartbeat
+
+        heartbeat += 1
+        if heartbeat > 100:
+            heartbeat = 0
+
+        #the whole screen is built up here and written in one go
+        frame = [CLEAR, 'ID    Safety\tState\t\tLast CMD\tVoltage\t\tUsrCode\n']
+        now = time.time()
+
+        #keep track of any bots that may have timed out (we haven't heard from in forever.)
+        while expiry_heap and expiry_heap[0][0] <= now:
+            _, sender, seq = heapq.heappop(expiry_heap)
+            if seq != update_seq[sender] or sender not in has_been_on: #heard from it since, or it said it turned off
+                continue
+            bot = bots_by_id[sender]
+            bot.voltage = 0
+            bot.state = 'off'
+            bot.last_command = 'none'
+            bot.safety = 0
+            bot.user_code = 'none'
+            timed_out.add(sender)
+        timeout_bots = sorted(timed_out)
+
+        for i,bot in enumerate(bots):
+            #bots we've never heard from (or that said they turned off) have nothing worth printing
+            if bot.state == 'off' and bot.id not in has_been_on:
+                continue
+
+            frame.append(f"{bot.id_str}\t{bot.safety}\t{bot.state}\t\t{bot.last_command}\t\t{bot.voltage:.2f}\t\t{bot.user_code}\n")
+
+        frame.append('\n\n')
+        frame.append('Optitrack Info:\n')
+        frame.append('Bodies: %d\tLR: %0.2f\t Missed Counts: %d\tHB: %d\n' %(opti_info['num_bots'], opti_info['opti_loss'], opti_info['count_diff'], heartbeat))
+        frame.append('Time btwn: %0.3f \tTimeout bots: %s\n' %(opti_info['avg_time_between'], str(timeout_bots)))
+        sys.stdout.write(''.join(frame))
+        sys.stdout.flush()
+
+        loop.call_later(time_between_prints, reprint)
+
+    #the event loop (epoll on linux) calls these as soon as their socket has data, and runs the reprint timer in between
+    loop.add_reader(recv_socket.fileno(), receive_bots)
+    loop.add_reader(opti_udp.client_socket.fileno(), receive_optitrack)
+    reprint()
 
- 
-            #NOW GET DATA FROM OPTITRACK!!!
-            opti_data = opti_udp.run()
-            # print(opti_data)
-            if opti_data == False:
-                pass
-            else:
-                # print(opti_data)
-                num_bots = opti_data[0]
-                opti_loss = opti_data[1]
-                count_diff = opti_data[2]
-                avg_time_between = opti_data[3]
-                reprint = True
-
-
-    except KeyboardInterrupt:
-        print('User interrupted.')
-        os.system('clear')
-        
+    try:
+        await loop.create_future() #runs until interrupted
     finally:
-        pass
-        
+        loop.remove_reader(recv_socket.fileno())
+        loop.remove_reader(opti_udp.client_socket.fileno())
+
+
+
+def set_realtime(opti_socket):
+    '''
+    Optional scheduling tweaks (linux only) so optitrack packets are serviced with less jitter. Both are off unless asked for:
+    LISTENER_RT_PRIORITY=<1-99> runs the listener under SCHED_FIFO at that priority (needs root or CAP_SYS_NICE)
+    LISTENER_CPU=<n> pins the listener to cpu n, and sets SO_INCOMING_CPU on the optitrack socket to n.
+    (SO_INCOMING_CPU only matters if several sockets share the port with SO_REUSEPORT: it picks the socket whose cpu
+    matches the one the packet came in on. It doesn't move the kernel's packet handling to that cpu.)
+    If a tweak isn't allowed or the value is bad, it says so and carries on with the normal settings.
+    '''
+    priority = os.environ.get('LISTENER_RT_PRIORITY')
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(int(priority)))
+            print('Listener running with SCHED_FIFO priority %s' % priority)
+        except (OSError, AttributeError, ValueError) as e: #PermissionError if not root, AttributeError if not linux, ValueError if not a number
+            print('Could not set SCHED_FIFO priority %r (%s), using the normal scheduler' % (priority, e))
+
+    cpu = os.environ.get('LISTENER_CPU')
+    if cpu:
+        try:
+            os.sched_setaffinity(0, {int(cpu)})
+            opti_socket.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, int(cpu))
+            print('Listener pinned to cpu %s' % cpu)
+        except (OSError, AttributeError, ValueError) as e:
+            print('Could not pin the listener to cpu %r (%s), using the normal settings' % (cpu, e))
 
 
-def process_inbound(recv_data):
+def process_inbound(raw):
     '''
-    Processes the received data into messages using headers and message length info
-    returns a list of all messges received from that particular IP address.
-    returns FALSE if failure
+    Processes the received bytes into messages using headers and message length info
+    returns a list of all messges received from that particular IP address (each message is a list of its raw bytes fields).
+    returns an empty list if there are no complete messages
     '''
     msgs = []
-    msg_start_indexes = []
-    msg_end_indexes = []
 
-    try:
-        offset = 2 #where the actual message starts w.r.t the 'abc' value
-        split_message = recv_data.split(',')
-
-        #This bit gives us each message from the client (in case there were multiple. Usually only one)
-        for i, part in enumerate(split_message):
-            if part == 'abc':
-                msg_start_indexes.append(i+offset)
-                msg_len = int(split_message[i+1]) #get the length of the message (stored after abc)
-                msg_end_indexes.append(i+offset+msg_len)
-
-        #This loops through each message and process it so its ready to be returned.
-        for i,index in enumerate(msg_start_indexes):
-            msgs.append(split_message[index:msg_end_indexes[i]])
-                        
-        if len(msgs) > 0:
-            return msgs
-        else:
-            return False
-    except:
-        return False
+    #Each message from the client is an 'abc' field, the message length, then the fields (in case there were multiple. Usually only one)
+    #Splitting on the ',abc,' header gives every message in one pass (the leading comma makes sure 'abc' is a whole field,
+    #and the first part is whatever came before the first header, so it's skipped)
+    for chunk in (b',' + raw).split(b',abc,')[1:]:
+        length, _, fields = chunk.partition(b',')
+        if not length.isdigit():
+            continue
+        msg_len = int(length) #get the length of the message (stored after abc)
+
+        #split off just this message's fields, and only keep it if they are all there
+        msg = fields.split(b',', msg_len)[:msg_len]
+        if len(msg) == msg_len:
+            msgs.append(msg)
+
+    return msgs
 
 
 class OptitrackInterfaceUDP():
     '''
     Class to interface with optitrack and get data from the optitrack machine using UDP
     '''
-    def __init__(self, id = 2, ip="224.1.1.1", port=54321) -> None:
+    #tag, timestamp, sequence number (14 bytes, native alignment like the sender)
+    PREAMBLE = struct.Struct('5sfH')
+    PREAMBLE_SIZE = PREAMBLE.size #14 bytes
+    BODY_SIZE = 29 #bytes per rigid body (id, x, y, z, q1, q2, q3, q4)
+
+    def __init__(self, id = 2, ip="224.1.1.1", port=54321, iface_ip="0.0.0.0") -> None:
         '''
         gets a unique robot id (default id = 2 for the air traffic controller) and stores it
 
         Creates a udp client socket to listen for information from the optitrack computer. 
         DEVELOPERS NOTE: Port and ip address are for the optitrack computer (which acts as a server.)
+        iface_ip is the IPv4 address of the local network card that is on the optitrack network.
+        Leave it as 0.0.0.0 to let the kernel pick, but on a machine with more than one network card
+        the kernel may join the multicast group on the wrong one and we never see the packets.
         '''       
 
         self.port = port
         self.ip = ip #IP address of MOTIVE machine
+        self.iface_ip = iface_ip #IP address of our network card on the MOTIVE network
 
         #set up a socket to receive messages from the server.
         #AF_INET is the internet address family for IPv4
@@ -233,25 +293,46 @@ class OptitrackInterfaceUDP():
         #REUSE THE PORT TOO (ONLY ON LINUX)
         self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-        #Increase buffer size
-        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)
+        #Increase buffer size, so packets aren't dropped while the main loop is busy (e.g. reprinting)
+        #SO_RCVBUFFORCE can go past the net.core.rmem_max limit but needs root (CAP_NET_ADMIN), otherwise SO_RCVBUF gets capped at rmem_max
+        try:
+            self.client_socket.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RCVBUF_SIZE)
+        except OSError:
+            self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        self.rcvbuf_size = self.client_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        print('Optitrack receive buffer: %d bytes' % self.rcvbuf_size)
 
         #We're going to listen to anything coming over the port from the ip address given
         self.client_socket.bind(('', self.port))
 
-        # Join the multicast group
-        mreq = struct.pack("4sL", socket.inet_aton(self.ip), socket.INADDR_ANY)
+        # Join the multicast group on the chosen network card (and send our multicast/IGMP traffic out of it too)
+        mreq = struct.pack("4s4s", socket.inet_aton(self.ip), socket.inet_aton(self.iface_ip))
         self.client_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.client_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.iface_ip))
 
         #make the socket blocking
         self.client_socket.setblocking(False)
-        
+
+        #buffers for recvmmsg, allocated once and reused for every batch (one contiguous block, RECV_SIZE bytes per packet)
+        self.recv_buffer = ctypes.create_string_buffer(RECV_BATCH * RECV_SIZE)
+        self.recv_iovecs = (IOVec * RECV_BATCH)()
+        self.recv_msgs = (MMsgHdr * RECV_BATCH)()
+        buffer_address = ctypes.addressof(self.recv_buffer)
+        for i in range(RECV_BATCH):
+            self.recv_iovecs[i].iov_base = buffer_address + i * RECV_SIZE
+            self.recv_iovecs[i].iov_len = RECV_SIZE
+            self.recv_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            self.recv_msgs[i].msg_hdr.msg_iovlen = 1
+        #a view of each packet's slot in the buffer, so received packets can be read without copying them out
+        recv_view = memoryview(self.recv_buffer).cast('B')
+        self.recv_slots = [recv_view[i*RECV_SIZE:(i+1)*RECV_SIZE] for i in range(RECV_BATCH)]
 
         self.id = id
 
         self.last_opti_count = 0
-        self.lost_message_tracker = np.zeros(1000) #100 == 1s of data, so 1000 is 10s
+        self.lost_message_tracker = bytearray(1000) #1 == lost, 0 == received. 100 == 1s of data, so 1000 is 10s
         self.lost_message_pointer = 0
+        self.lost_count = 0 #number of 1s in lost_message_tracker, so the loss rate doesn't need a sum over the whole tracker
         self.first_data = True
 
         self.avg_time_between = 0.0
@@ -263,98 +344,154 @@ class OptitrackInterfaceUDP():
         listen for incoming information from the optitrack system
         calculate and update shared memory data with new optitrack information.
         '''
-        try:
-            recv_data, addr = self.client_socket.recvfrom(1024) #data will return already decoded, but not split
-            data_length = len(recv_data)
-
-            log_no_data = False #set this to True if you want to log that data was missed for this particular loop 
-            error_msg = 'normal' #set this to identify the reason data was lost.
-
-            #if we got data to parse
-            if recv_data:
-
-                self.__time_of_last_receipt = time.time()
-
-                #We assume we only have 1 message per 1024 bytes pulled from the receive buffer.
-                #We quickly check this by looking at the length of the data. We expect each message to be less than 800 bytes long (29bytes*25drones=725)
-                #if we only have 1 message, we know 'optiX' should be at the beginning, 
-                #and we are looking for 'optiX' because that is the identifier at the beginning of each optitrack message
-                ##where 'optiX' could be 'opti1' for IDs 5-29 and 'opti2' for IDs 30-54
-                #if we have more than 1 message, we loop through until we find 'optiX'
-
-                #messages are in the format: 'opti', timestamp, sequence number, id, x, y, z, q1, q2, q3, q4, id, x, y, z, q1, q2, q3, q4,
-                #                                                                 0, 1, 2, 3,  4,  5,  6,  7,
-
-                data_found = False
-                message_start = [] #will be used to hold the indexes of the beginning of the message
-                if data_length < 800:
-                    segment = struct.unpack('5s', recv_data[0:5])[0]
-                    #try to turn the segment of the message into a string. If you can't do that (UnicodeDecodeError, just continue to the next message)
-                    try:
-                        segment = segment.decode('utf-8')
-                    except UnicodeDecodeError:
-                        return False
+        opti_data = False
 
-                    if segment == 'opti1' or segment == 'opti2':
-                        preamble = struct.unpack('5sfH', recv_data[0:14])
-                        optitime = preamble[1]
-                        opticount = preamble[2]
-                        #Make sure the sequence number is not an old one.
-                        #and check the roll over at 65535 (if we miss more than 200 messages, we are screwed anyway)
-                        roll_over_flag = False
-                        if opticount < 0+100 and self.last_opti_count > 65535 - 100:
-                            roll_over_flag = True
-                        if opticount <= self.last_opti_count and not roll_over_flag:
-                            data_found = False
-                            return False
-                        time_found = time.time()
-                        data_found = True
+        #keep pulling batches until the socket is empty, so a backlog (e.g. from a slow reprint) is cleared in one call.
+        #every packet goes through the loss tracking (in order, so packets we did get aren't counted as lost),
+        #but only the newest valid packet's numbers are returned.
+        while True:
+            datagrams = self.receive_batch()
+            for recv_data in datagrams:
+                packet_data = self.process_packet(recv_data)
+                if packet_data:
+                    opti_data = packet_data
+            if len(datagrams) < RECV_BATCH: #a short batch means nothing else is waiting
+                break
+        return opti_data
+
+    def receive_batch(self):
+        '''
+        Pulls every packet waiting on the socket (up to RECV_BATCH) in a single recvmmsg call.
+        Returns a list with the data of each packet, oldest first (empty if nothing was waiting).
+        Falls back to recvfrom_into (one packet at a time) if recvmmsg isn't available.
+        The packets are memoryviews into recv_buffer, so they are only good until the next call.
+        '''
+        if recvmmsg is None:
+            datagrams = []
+            while len(datagrams) < RECV_BATCH:
+                slot = self.recv_slots[len(datagrams)]
+                try:
+                    data_length, addr = self.client_socket.recvfrom_into(slot, RECV_SIZE)
+                except BlockingIOError:
+                    # print('blocking error')
+                    break
+                datagrams.append(slot[:data_length])
+            return datagrams
+
+        count = recvmmsg(self.client_socket.fileno(), self.recv_msgs, RECV_BATCH, socket.MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                return []
+            raise OSError(err, os.strerror(err))
+
+        return [self.recv_slots[i][:self.recv_msgs[i].msg_len] for i in range(count)]
+
+    def fill_tracker(self, value, n):
+        '''
+        Writes value into the next n slots of lost_message_tracker (wrapping around at the end), and moves the pointer past them.
+        Done with slice assignments instead of one slot at a time, so a big gap costs the same as a small one.
+        lost_count is updated by taking off the 1s that were in the overwritten slots and adding the new ones.
+        '''
+        tracker = self.lost_message_tracker
+        size = len(tracker)
+        if n > size: #the tracker only holds the last size slots, so skip ahead to those
+            self.lost_message_pointer = (self.lost_message_pointer + n - size) % size
+            n = size
+
+        start = self.lost_message_pointer
+        first = min(n, size - start) #slots before the end of the tracker
+        rest = n - first #slots after wrapping around to the start
+
+        old_lost = tracker.count(1, start, start + first) + tracker.count(1, 0, rest)
+        fill = bytes([value])
+        tracker[start:start + first] = fill * first
+        tracker[0:rest] = fill * rest
+
+        self.lost_count += value * n - old_lost
+        self.lost_message_pointer = (start + n) % size
+
+    def process_packet(self, recv_data):
+        '''
+        Parses one packet from the optitrack system and updates the loss/timing statistics.
+        Returns [num_bodies, percent_loss, missed counts, avg_time_between], or False if the packet isn't new optitrack data.
+        '''
+        data_length = len(recv_data)
+
+        log_no_data = False #set this to True if you want to log that data was missed for this particular loop 
+        error_msg = 'normal' #set this to identify the reason data was lost.
+
+        #if we got data to parse
+        if recv_data:
+
+            now = time.time() #read the clock once per packet
+            self.__time_of_last_receipt = now
+
+            #We assume we only have 1 message per 1024 bytes pulled from the receive buffer.
+            #We quickly check this by looking at the length of the data. We expect each message to be less than 800 bytes long (29bytes*25drones=725)
+            #if we only have 1 message, we know 'optiX' should be at the beginning, 
+            #and we are looking for 'optiX' because that is the identifier at the beginning of each optitrack message
+            ##where 'optiX' could be 'opti1' for IDs 5-29 and 'opti2' for IDs 30-54
+            #if we have more than 1 message, we loop through until we find 'optiX'
+
+            #messages are in the format: 'opti', timestamp, sequence number, id, x, y, z, q1, q2, q3, q4, id, x, y, z, q1, q2, q3, q4,
+            #                                                                 0, 1, 2, 3,  4,  5,  6,  7,
+
+            data_found = False
+            message_start = [] #will be used to hold the indexes of the beginning of the message
+            if data_length < 800:
+                #check the tag as raw bytes, no need to unpack or decode it
+                if bytes(recv_data[:5]) in VALID_TAGS:
+                    preamble = self.PREAMBLE.unpack_from(recv_data, 0)
+                    optitime = preamble[1]
+                    opticount = preamble[2]
+                    #Make sure the sequence number is not an old one.
+                    #and check the roll over at 65535 (if we miss more than 200 messages, we are screwed anyway)
+                    roll_over_flag = False
+                    if opticount < 0+100 and self.last_opti_count > 65535 - 100:
+                        roll_over_flag = True
+                    if opticount <= self.last_opti_count and not roll_over_flag:
+                        data_found = False
+                        return False
+                    time_found = now
+                    data_found = True
+            else:
+                print('data too long!!')
+            
+            
+            if data_found:
+                if self.first_data:
+                    percent_loss = 0.0
+                    self.first_data = False
+                    msg_count_diff = 1
                 else:
-                    print('data too long!!')
-                
-                
-                if data_found:
-                    if self.first_data:
-                        percent_loss = 0.0
-                        self.first_data = False
-                        msg_count_diff = 1
+
+                    msg_count_diff = int(opticount - self.last_opti_count)%65536
+                    #if the difference is one, we missed no messages
+                    #lost_count is kept in step with the tracker: whenever a slot is overwritten, add the new value and take off the old one.
+                    if msg_count_diff == 1:
+                        self.lost_count -= self.lost_message_tracker[self.lost_message_pointer]
+                        self.lost_message_tracker[self.lost_message_pointer] = 0
+                        self.lost_message_pointer = (self.lost_message_pointer + 1) % len(self.lost_message_tracker)
                     else:
+                        #if the difference is greater than one, we missed some messages and need to update our tracker accordingly
+                        #(a 1 for every missed message, then a 0 for this one)
+                        self.fill_tracker(1, msg_count_diff - 1)
+                        self.fill_tracker(0, 1)
+                    
+                    percent_loss = (self.lost_count/len(self.lost_message_tracker))*100
+
+                time_difference = time_found - self.last_time_found
+                self.avg_time_between = self.alpha * time_difference + (1-self.alpha) * self.avg_time_between
 
-                        msg_count_diff = int(opticount - self.last_opti_count)%65536
-                        #if the difference is one, we missed no messages
-                        if msg_count_diff == 1:
-                            self.lost_message_tracker[self.lost_message_pointer] = 0
-                            self.lost_message_pointer += 1
-                            if self.lost_message_pointer >= len(self.lost_message_tracker):
-                                self.lost_message_pointer = 0
-                        else:
-                            #if the difference is greater than one, we missed some messages and need to update our tracker accordingly
-                            for i in range(0,msg_count_diff):
-                                if i == msg_count_diff - 1:
-                                    self.lost_message_tracker[self.lost_message_pointer] = 0
-                                else:
-                                    self.lost_message_tracker[self.lost_message_pointer] = 1
-                                
-                                self.lost_message_pointer += 1
-                                if self.lost_message_pointer >= len(self.lost_message_tracker):
-                                    self.lost_message_pointer = 0
-                        
-                        percent_loss = (np.sum(self.lost_message_tracker)/len(self.lost_message_tracker))*100
-
-                    time_difference = time_found - self.last_time_found
-                    self.avg_time_between = self.alpha * time_difference + (1-self.alpha) * self.avg_time_between
-
-                    #estimate number of bodies by message size
-                    num_bodies = int((data_length-14)/29) #preamble is 14 bytes, and each robot is 29 bytes
-                    num_bodies = 42
-
-                    self.last_opti_count = opticount
-                    self.last_time_found = time_found
-                    return [num_bodies, percent_loss, msg_count_diff-1, self.avg_time_between]
-                
-        except BlockingIOError:
-            # print('blocking error')
-            return False
+                #estimate number of bodies by message size
+                num_bodies = (data_length - self.PREAMBLE_SIZE) // self.BODY_SIZE #preamble is 14 bytes, and each robot is 29 bytes
+
+                self.last_opti_count = opticount
+                self.last_time_found = time_found
+                return [num_bodies, percent_loss, msg_count_diff-1, self.avg_time_between]
+            
+        return False
 
 
         # num_bots = opti_data[0]
@@ -372,4 +509,9 @@ class OptitrackInterfaceUDP():
 
 
 
-main()
\ No newline at end of file
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    print('User interrupted.')
+    sys.stdout.write(CLEAR)
+    sys.stdout.flush()
\ No newline at end of file